@@ -1,17 +1,52 @@
 from flask import (
     Flask, request, jsonify, render_template,
-    redirect, url_for, session, Response
+    redirect, url_for, session, Response, stream_with_context
 )
 import sqlite3
 from datetime import datetime
 import json
 import os
 import functools
-
+import calendar
+import csv
+import io
+import hashlib
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (always compact output)."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(
+            obj, default=self.default, option=orjson.OPT_NON_STR_KEYS
+        ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+# Number of reverse proxies in front of the app that append X-Forwarded-For.
+# Only trust the header when deployed behind them (Render's proxy: 1), so
+# request.remote_addr is the real client for the login rate limit; otherwise
+# clients could spoof it. Defaults to 0 (use the socket address).
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "0"))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
 DB_PATH = "annapurna.db"
 
@@ -19,6 +54,38 @@ DB_PATH = "annapurna.db"
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "secretkey")
 ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "changeme")
 
+# Password hashing. Production uses argon2id; dev/test can set any werkzeug
+# method instead, e.g. PASSWORD_HASH_METHOD=pbkdf2:sha256:1000, to make logins
+# cheap. Only when the method is argon2 are other (or outdated argon2) hashes
+# upgraded on the next successful login; other methods leave hashes as they are.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "argon2")
+PASSWORD_HASH_ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", "600000"))
+_argon2 = PasswordHasher(
+    time_cost=int(os.environ.get("ARGON2_TIME_COST", "2")),
+    memory_cost=int(os.environ.get("ARGON2_MEMORY_COST", "65536")),  # KiB
+    parallelism=int(os.environ.get("ARGON2_PARALLELISM", "1")),
+)
+
+# Failed login attempts allowed per client address within the window
+LOGIN_MAX_FAILURES = 5
+LOGIN_FAILURE_WINDOW = 60  # seconds
+LOGIN_FAILURES_SWEEP_AT = 1024  # tracked addresses before expired ones are purged
+_login_failures = {}
+_login_failures_lock = threading.Lock()
+
+# username -> (expires_at, (username, password_hash)) for admin_login
+ADMIN_HASH_TTL = 30  # seconds
+_admin_hash_cache = {}
+
+# Snapshot of known admin usernames so unknown names never reach the DB.
+# It doubles as the negative cache, so keep it to 1s: an admin created on
+# another worker can log in almost immediately.
+ADMIN_USERNAMES_TTL = 1  # seconds
+_admin_usernames = {"entry": None}  # (expires_at, frozenset)
+
+# Hash checked in place of a real one for unknown usernames (built lazily)
+_dummy_hash = {"value": None}
+
 
 def login_required(view):
     @functools.wraps(view)
@@ -28,27 +95,191 @@ def login_required(view):
         return view(**kwargs)
     return wrapped_view
 
-def create_admin_user(username, password):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    password_hash = generate_password_hash(password)
-    try:
-        c.execute(
-            "INSERT INTO admins (username, password_hash) VALUES (?, ?)",
-            (username, password_hash),
+
+def hash_password(password):
+    """Hash a password with the configured method (and pbkdf2 iteration count)."""
+    method = PASSWORD_HASH_METHOD
+    if method == "argon2":
+        return _argon2.hash(password)
+    if method.startswith("pbkdf2") and method.count(":") == 1:
+        method = f"{method}:{PASSWORD_HASH_ITERATIONS}"
+    return generate_password_hash(password, method=method, salt_length=16)
+
+
+def verify_password(password_hash, password):
+    """
+    Check a password against an argon2 or legacy werkzeug hash.
+    Returns (matches, needs_rehash).
+    """
+    if password_hash.startswith("$argon2"):
+        try:
+            _argon2.verify(password_hash, password)
+        except (VerifyMismatchError, InvalidHashError):
+            return False, False
+        rehash = PASSWORD_HASH_METHOD == "argon2" and _argon2.check_needs_rehash(password_hash)
+        return True, rehash
+    if not check_password_hash(password_hash, password):
+        return False, False
+    return True, PASSWORD_HASH_METHOD == "argon2"
+
+
+def _recent_login_failures(addr, now):
+    """Drop expired entries for addr and return how many failures remain."""
+    failures = _login_failures.get(addr)
+    if failures is None:
+        return 0
+    while failures and now - failures[0] > LOGIN_FAILURE_WINDOW:
+        failures.popleft()
+    if not failures:
+        del _login_failures[addr]
+    return len(failures)
+
+
+def _record_login_failure(addr, now):
+    # Sweep addresses whose failures have all expired so the dict stays small
+    if len(_login_failures) >= LOGIN_FAILURES_SWEEP_AT:
+        for stale in list(_login_failures):
+            _recent_login_failures(stale, now)
+    _login_failures.setdefault(addr, deque()).append(now)
+
+
+def _dummy_password_hash():
+    """
+    Hash checked for unknown usernames so they cost the same as real ones.
+    Built on the first miss (not at import, so worker boots stay hash-free)
+    with the scheme most stored admin hashes use, so timing still matches
+    while legacy hashes are waiting to be upgraded on login.
+    """
+    if _dummy_hash["value"] is None:
+        rows = get_db().execute("SELECT password_hash FROM admins").fetchall()
+        schemes = Counter(
+            "argon2" if h.startswith("$argon2") else h.split("$", 1)[0]
+            for (h,) in rows
         )
-        conn.commit()
+        secret = os.urandom(16).hex()
+        scheme = schemes.most_common(1)[0][0] if schemes else None
+        if scheme is None:
+            _dummy_hash["value"] = hash_password(secret)
+        elif scheme == "argon2":
+            _dummy_hash["value"] = _argon2.hash(secret)
+        else:
+            _dummy_hash["value"] = generate_password_hash(secret, method=scheme)
+    return _dummy_hash["value"]
+
+
+def _known_admin_usernames(now):
+    entry = _admin_usernames["entry"]
+    if entry is None or entry[0] <= now:
+        rows = get_db().execute("SELECT username FROM admins").fetchall()
+        entry = (now + ADMIN_USERNAMES_TTL, frozenset(r["username"] for r in rows))
+        _admin_usernames["entry"] = entry
+    return entry[1]
+
+
+def _lookup_admin_hash(username):
+    """Return (username, password_hash) for an admin, or None; cached briefly."""
+    now = time.monotonic()
+    hit = _admin_hash_cache.get(username)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    if username not in _known_admin_usernames(now):
+        return None
+
+    row = get_db().execute(SQL_SELECT_ADMIN_HASH, (username,)).fetchone()
+    if row is None:
+        return None
+    result = (row["username"], row["password_hash"])
+    _admin_hash_cache[username] = (now + ADMIN_HASH_TTL, result)
+    return result
+
+
+def _invalidate_admin_caches():
+    _admin_hash_cache.clear()
+    _admin_usernames["entry"] = None
+    _dummy_hash["value"] = None
+
+
+def create_admin_user(username, password):
+    password_hash = hash_password(password)
+    # OR IGNORE: another worker may have created the same user concurrently
+    with db_writer() as conn:
+        created = conn.execute(
+            SQL_INSERT_ADMIN_IF_ABSENT, (username, password_hash)
+        ).rowcount
+    if created:
+        _invalidate_admin_caches()
         print(f"Admin user '{username}' created.")
-    except sqlite3.IntegrityError:
+    else:
         print(f"Admin user '{username}' already exists.")
-    finally:
-        conn.close()
+
+
+# Orders table: each order placed from the website.
+# created_at is UTC unix epoch milliseconds; created_at_iso is derived from it.
+ORDERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        total REAL NOT NULL,
+        data TEXT NOT NULL,  -- JSON with items, notes, pickup, etc.
+        created_at_iso TEXT GENERATED ALWAYS AS (
+            strftime('%Y-%m-%dT%H:%M:%fZ', created_at / 1000.0, 'unixepoch')
+        ) VIRTUAL,
+        FOREIGN KEY (phone) REFERENCES customers(phone)
+    )
+"""
+
+# Payments table: admin records payments against a phone number
+PAYMENTS_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        amount REAL NOT NULL,
+        note TEXT,
+        created_at_iso TEXT GENERATED ALWAYS AS (
+            strftime('%Y-%m-%dT%H:%M:%fZ', created_at / 1000.0, 'unixepoch')
+        ) VIRTUAL,
+        FOREIGN KEY (phone) REFERENCES customers(phone)
+    )
+"""
+
+
+def now_millis():
+    """Current UTC time as integer unix epoch milliseconds."""
+    return int(time.time() * 1000)
+
+
+def _migrate_created_at_to_millis(c, table, schema):
+    """Rebuild a table whose created_at is still ISO text with integer millis."""
+    columns = {row[1]: row[2] for row in c.execute(f"PRAGMA table_info({table})")}
+    if columns.get("created_at", "").upper() != "TEXT":
+        return
+
+    # Everything except the generated column is copied across
+    cols = ", ".join(name for name in columns if name != "created_at")
+    c.execute(f"DROP TABLE IF EXISTS {table}_new")
+    c.execute(schema.format(name=f"{table}_new"))
+    c.execute(f"""
+        INSERT INTO {table}_new (created_at, {cols})
+        SELECT CAST(ROUND((julianday(created_at) - 2440587.5) * 86400000) AS INTEGER),
+               {cols}
+        FROM {table}
+    """)
+    c.execute(f"DROP TABLE {table}")
+    c.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    print(f"Migrated {table}.created_at to unix milliseconds.")
 
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
 
+    # WAL lets readers run alongside the writer; the setting sticks to the file
+    c.execute("PRAGMA journal_mode=WAL")
+    for pragma in CONNECTION_PRAGMAS:
+        c.execute(pragma)
+
     # Admins table for real login
     c.execute("""
         CREATE TABLE IF NOT EXISTS admins (
@@ -66,29 +297,13 @@ def init_db():
         )
     """)
 
-    # Orders table: each order placed from the website
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS orders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            total REAL NOT NULL,
-            data TEXT NOT NULL,  -- JSON with items, notes, pickup, etc.
-            FOREIGN KEY (phone) REFERENCES customers(phone)
-        )
-    """)
-
-    # Payments table: admin records payments against a phone number
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            amount REAL NOT NULL,
-            note TEXT,
-            FOREIGN KEY (phone) REFERENCES customers(phone)
-        )
-    """)
+    # Orders and payments; older databases stored created_at as ISO text
+    c.execute(ORDERS_TABLE.format(name="orders"))
+    c.execute(PAYMENTS_TABLE.format(name="payments"))
+    c.execute("BEGIN IMMEDIATE")  # one worker migrates, the others wait
+    for table, schema in (("orders", ORDERS_TABLE), ("payments", PAYMENTS_TABLE)):
+        _migrate_created_at_to_millis(c, table, schema)
+    conn.commit()
 
     # Menu config table: single row with id=1
     c.execute(
@@ -107,100 +322,330 @@ def init_db():
         """
     )
 
+    # Indexes for the per-phone listings (newest first)
+    index_count = "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index'"
+    indexes_before = c.execute(index_count).fetchone()[0]
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_orders_phone_created "
+        "ON orders(phone, created_at DESC)"
+    )
+    c.execute(
+        "CREATE INDEX IF NOT EXISTS idx_payments_phone_created "
+        "ON payments(phone, created_at DESC)"
+    )
+    # The monthly CSV aggregates in one GROUP BY phone pass, so a created_at
+    # index would only slow inserts; drop it where an older build made one
+    c.execute("DROP INDEX IF EXISTS idx_orders_created")
+    c.execute("DROP INDEX IF EXISTS idx_payments_created")
+
+    # Refresh planner statistics only when the set of indexes changed (e.g.
+    # after the first boot or the created_at migration), not on every boot
+    if c.execute(index_count).fetchone()[0] != indexes_before:
+        c.execute("ANALYZE")
 
     conn.commit()
 
-    # 🔹 Ensure at least one admin user exists
-    c.execute("SELECT COUNT(*) FROM admins")
-    count = c.fetchone()[0]
+    # 🔹 Ensure at least one admin user exists. Only hash a password when the
+    # table is actually empty; every worker runs this at import.
+    has_admin = c.execute("SELECT 1 FROM admins LIMIT 1").fetchone() is not None
     conn.close()
 
-    if count == 0:
+    if not has_admin:
         # Use env vars if set, otherwise defaults
         username = os.environ.get("ADMIN_USERNAME", "annapurna")
         password = os.environ.get("ADMIN_PASSWORD", "Annapurnas213!")
         create_admin_user(username, password)
 
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# --- SQL statements ---
+# Kept as module constants so each connection's statement cache is hit with
+# the same string object every time.
+
+SQL_INSERT_ADMIN = "INSERT INTO admins (username, password_hash) VALUES (?, ?)"
+
+SQL_INSERT_ADMIN_IF_ABSENT = (
+    "INSERT OR IGNORE INTO admins (username, password_hash) VALUES (?, ?)"
+)
+
+SQL_UPDATE_ADMIN_HASH = "UPDATE admins SET password_hash = ? WHERE username = ?"
+
+SQL_SELECT_ADMIN_HASH = "SELECT username, password_hash FROM admins WHERE username = ?"
+
+# Insert the customer, or refresh their name if a non-empty one was given
+SQL_UPSERT_CUSTOMER = """
+    INSERT INTO customers (phone, name) VALUES (?, ?)
+    ON CONFLICT(phone) DO UPDATE SET
+        name = COALESCE(NULLIF(excluded.name, ''), customers.name)
+"""
+
+# Order JSON (full payload for later review) is built by SQLite
+SQL_INSERT_ORDER = """
+    INSERT INTO orders (phone, created_at, total, data)
+    VALUES (?, ?, ?, json_object(
+        'name', ?, 'phone', ?, 'pickupOption', ?, 'notes', ?,
+        'items', json(?), 'total', ?
+    ))
+"""
+
+SQL_INSERT_PAYMENT = """
+    INSERT INTO payments (phone, created_at, amount, note)
+    VALUES (?, ?, ?, ?)
+"""
+
+SQL_SELECT_MENU_CONFIG = """
+    SELECT menu_json, week_text, special_note,
+           cutoff_monday, cutoff_tuesday, cutoff_wednesday,
+           cutoff_thursday, cutoff_friday
+    FROM menu_config
+    WHERE id = 1
+"""
+
+SQL_SAVE_MENU_CONFIG = """
+    INSERT INTO menu_config (
+        id, menu_json, week_text, special_note,
+        cutoff_monday, cutoff_tuesday, cutoff_wednesday,
+        cutoff_thursday, cutoff_friday
+    )
+    VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+        menu_json = excluded.menu_json,
+        week_text = excluded.week_text,
+        special_note = excluded.special_note,
+        cutoff_monday = excluded.cutoff_monday,
+        cutoff_tuesday = excluded.cutoff_tuesday,
+        cutoff_wednesday = excluded.cutoff_wednesday,
+        cutoff_thursday = excluded.cutoff_thursday,
+        cutoff_friday = excluded.cutoff_friday
+"""
+
+
+# --- Connection pool ---
+# Each worker thread keeps one cached read connection for its whole lifetime,
+# so we don't reopen the file and throw away SQLite's page cache per request.
+# All writes go through a single shared writer connection behind a lock.
+
+# Per-connection settings (journal_mode=WAL is persistent and set in init_db):
+# fewer fsyncs, temp tables in RAM, memory-mapped reads, ~40MB page cache.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-40000",
+)
+
+_local = threading.local()
+_writer_lock = threading.Lock()
+_writer = None
+
+
+def _connect(isolation_level="DEFERRED"):
+    conn = sqlite3.connect(
+        DB_PATH,
+        check_same_thread=False,
+        isolation_level=isolation_level,
+        cached_statements=256,
+    )
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+
+def get_db():
+    """Return this thread's cached connection, opening it on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = _connect()
+    return conn
+
+
+@contextmanager
+def db_writer():
+    """Yield the shared writer connection; commit on success, roll back on error."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            # BEGIN IMMEDIATE: take the write lock when the transaction starts
+            _writer = _connect(isolation_level="IMMEDIATE")
+        try:
+            yield _writer
+            _writer.commit()
+        except Exception:
+            _writer.rollback()
+            raise
+
+
+@app.teardown_appcontext
+def reset_db(exc):
+    # Keep the connection open for the next request, just end any open read.
+    conn = getattr(_local, "conn", None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+
+# --- Write coalescing ---
+# Order and payment inserts are queued to one background thread that commits
+# them in batches, so a burst of requests shares a single commit/fsync. A lone
+# job is committed straight away; the thread only lingers (up to
+# WRITE_BATCH_WAIT) while more jobs keep arriving. This only pays off with
+# threaded workers; sync workers never have more than one job queued.
+# Each job runs in its own savepoint, so one failing job doesn't sink the rest.
+
+WRITE_BATCH_MAX = 64
+WRITE_BATCH_WAIT = 0.010  # seconds
+WRITE_TIMEOUT = 10  # seconds a request waits for its write to commit
+
+_write_queue = queue.Queue()
+_write_thread = None
+_write_thread_lock = threading.Lock()
+
+
+def submit_write(statements):
+    """
+    Run [(sql, params), ...] atomically in the next write batch and block
+    until it is committed. Re-raises the job's sqlite3 error, if any.
+    Raises FutureTimeoutError if the job was cancelled before it ran, in which case
+    nothing was written and the client can safely retry.
+    """
+    _ensure_write_thread()
+    future = Future()
+    _write_queue.put((statements, future))
+    try:
+        return future.result(timeout=WRITE_TIMEOUT)
+    except FutureTimeoutError:
+        if future.cancel():
+            raise
+        # Already running in a batch; its outcome is imminent
+        return future.result()
+
+
+def _ensure_write_thread():
+    global _write_thread
+    if _write_thread is not None and _write_thread.is_alive():
+        return
+    with _write_thread_lock:
+        if _write_thread is None or not _write_thread.is_alive():
+            _write_thread = threading.Thread(
+                target=_write_loop, name="sqlite-writer", daemon=True
+            )
+            _write_thread.start()
+
+
+def _write_loop():
+    while True:
+        batch = [_write_queue.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WAIT
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_write_queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            # Only linger for more jobs while a burst is actually arriving
+            remaining = deadline - time.monotonic()
+            if len(batch) == 1 or remaining <= 0:
+                break
+            try:
+                batch.append(_write_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _run_write_batch(batch)
+
+
+def _run_write_batch(batch):
+    outcomes = []
+    try:
+        with db_writer() as conn:
+            # Skip jobs whose request already gave up waiting (cancelled)
+            batch = [job for job in batch if job[1].set_running_or_notify_cancel()]
+            if not batch:
+                return
+            conn.execute("BEGIN IMMEDIATE")
+            for statements, future in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+                except sqlite3.Error as exc:
+                    conn.execute("ROLLBACK TO job")
+                    outcomes.append((future, exc))
+                else:
+                    outcomes.append((future, None))
+                conn.execute("RELEASE job")
+    except Exception as exc:
+        # The whole batch was rolled back
+        for _, future in batch:
+            if not future.cancelled():
+                future.set_exception(exc)
+        return
+
+    for future, exc in outcomes:
+        if exc is None:
+            future.set_result(None)
+        else:
+            future.set_exception(exc)
+
+
 # --- Menu config storage helpers ---
 
+# Serialized menu config JSON body and its ETag. Saving clears it in
+# this worker; the short TTL bounds how long other workers serve a stale copy.
+MENU_CACHE_TTL = 5  # seconds
+_menu_cache = {"entry": None}  # (expires_at, body, etag)
+
+
+def _menu_config_entry():
+    """Return the cached (expires_at, body, etag), reloading it if expired."""
+    entry = _menu_cache["entry"]
+    now = time.monotonic()
+    if entry is None or entry[0] <= now:
+        cfg = _load_menu_config()
+        body = app.json.dumps(cfg)
+        etag = hashlib.blake2b(body.encode()).hexdigest()[:16]
+        entry = _menu_cache["entry"] = (now + MENU_CACHE_TTL, body, etag)
+    return entry
+
 
-def get_or_create_menu_config():
+def _load_menu_config():
     """Fetch menu config row (id=1). If none, return an 'empty' structure."""
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT * FROM menu_config WHERE id = 1")
+    # Plain tuples (no Row factory) unpacked positionally
+    c = get_db().cursor()
+    c.row_factory = None
+    c.execute(SQL_SELECT_MENU_CONFIG)
     row = c.fetchone()
-    conn.close()
-
-    if row:
-        return {
-            "menu_json": row["menu_json"],
-            "week_text": row["week_text"] or "",
-            "special_note": row["special_note"] or "",
-            "cutoffs": {
-                "Monday": row["cutoff_monday"] or "",
-                "Tuesday": row["cutoff_tuesday"] or "",
-                "Wednesday": row["cutoff_wednesday"] or "",
-                "Thursday": row["cutoff_thursday"] or "",
-                "Friday": row["cutoff_friday"] or "",
-            },
-        }
 
     # No row yet – frontend will fall back to its own defaults
+    mj, wt, sn, cm, ct, cw, cth, cf = row or ("",) * 8
     return {
-        "menu_json": "",
-        "week_text": "",
-        "special_note": "",
+        "menu_json": mj,
+        "week_text": wt or "",
+        "special_note": sn or "",
         "cutoffs": {
-            "Monday": "",
-            "Tuesday": "",
-            "Wednesday": "",
-            "Thursday": "",
-            "Friday": "",
+            "Monday": cm or "",
+            "Tuesday": ct or "",
+            "Wednesday": cw or "",
+            "Thursday": cth or "",
+            "Friday": cf or "",
         },
     }
 
 
 def save_menu_config(payload: dict):
-    conn = get_db()
-    c = conn.cursor()
-    c.execute(
-        """
-        INSERT INTO menu_config (
-            id, menu_json, week_text, special_note,
-            cutoff_monday, cutoff_tuesday, cutoff_wednesday,
-            cutoff_thursday, cutoff_friday
+    with db_writer() as conn:
+        conn.execute(
+            SQL_SAVE_MENU_CONFIG,
+            (
+                payload.get("menu_json", ""),
+                payload.get("week_text", ""),
+                payload.get("special_note", ""),
+                payload.get("cutoffs", {}).get("Monday", ""),
+                payload.get("cutoffs", {}).get("Tuesday", ""),
+                payload.get("cutoffs", {}).get("Wednesday", ""),
+                payload.get("cutoffs", {}).get("Thursday", ""),
+                payload.get("cutoffs", {}).get("Friday", ""),
+            ),
         )
-        VALUES (1, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(id) DO UPDATE SET
-            menu_json = excluded.menu_json,
-            week_text = excluded.week_text,
-            special_note = excluded.special_note,
-            cutoff_monday = excluded.cutoff_monday,
-            cutoff_tuesday = excluded.cutoff_tuesday,
-            cutoff_wednesday = excluded.cutoff_wednesday,
-            cutoff_thursday = excluded.cutoff_thursday,
-            cutoff_friday = excluded.cutoff_friday
-        """,
-        (
-            payload.get("menu_json", ""),
-            payload.get("week_text", ""),
-            payload.get("special_note", ""),
-            payload.get("cutoffs", {}).get("Monday", ""),
-            payload.get("cutoffs", {}).get("Tuesday", ""),
-            payload.get("cutoffs", {}).get("Wednesday", ""),
-            payload.get("cutoffs", {}).get("Thursday", ""),
-            payload.get("cutoffs", {}).get("Friday", ""),
-        ),
-    )
-    conn.commit()
-    conn.close()
+    _menu_cache["entry"] = None
 
 
 @app.route("/")
@@ -209,10 +654,14 @@ def index():
     return render_template("index.html")
 
 
+# Pre-encoded health check body; no dict or JSON encoding per probe
+_HEALTH_BODY = b'{"status":"ok"}\n'
+
+
 @app.route("/health")
 def health():
     """Health check endpoint for Render.com"""
-    return jsonify({"status": "ok"}), 200
+    return Response(_HEALTH_BODY, status=200, mimetype="application/json")
 
 
 @app.route("/admin/login", methods=["GET", "POST"])
@@ -221,19 +670,34 @@ def admin_login():
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
-
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT id, username, password_hash FROM admins WHERE username = ?", (username,))
-        row = c.fetchone()
-        conn.close()
-
-        if row and check_password_hash(row["password_hash"], password):
+        addr = request.remote_addr or ""
+
+        with _login_failures_lock:
+            too_many = _recent_login_failures(addr, time.monotonic()) >= LOGIN_MAX_FAILURES
+        if too_many:
+            error = "Too many failed attempts. Please wait a minute and try again."
+            return render_template("admin_login.html", error=error), 429
+
+        admin = _lookup_admin_hash(username)
+
+        # Always run one hash check (against a dummy for unknown usernames) so
+        # response time doesn't reveal which usernames exist
+        stored_hash = admin[1] if admin else _dummy_password_hash()
+        matches, needs_rehash = verify_password(stored_hash, password)
+        if matches and admin:
+            with _login_failures_lock:
+                _login_failures.pop(addr, None)
+            if needs_rehash:
+                with db_writer() as conn:
+                    conn.execute(SQL_UPDATE_ADMIN_HASH, (hash_password(password), admin[0]))
+                _invalidate_admin_caches()
             session["admin_logged_in"] = True
-            session["admin_username"] = row["username"]
+            session["admin_username"] = admin[0]
             next_url = request.args.get("next") or url_for("admin_page")
             return redirect(next_url)
         else:
+            with _login_failures_lock:
+                _record_login_failure(addr, time.monotonic())
             error = "Invalid username or password."
 
     return render_template("admin_login.html", error=error)
@@ -246,11 +710,7 @@ def list_admins():
     Return a simple list of admin users (id + username).
     No passwords are returned for security reasons.
     """
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("SELECT id, username FROM admins ORDER BY username")
-    rows = c.fetchall()
-    conn.close()
+    rows = get_db().execute("SELECT id, username FROM admins ORDER BY username").fetchall()
 
     admins = [{"id": row["id"], "username": row["username"]} for row in rows]
     return jsonify(admins)
@@ -272,21 +732,15 @@ def create_admin():
     if len(password) < 6:
         return jsonify({"error": "Password should be at least 6 characters."}), 400
 
-    conn = get_db()
-    c = conn.cursor()
-    password_hash = generate_password_hash(password)
+    password_hash = hash_password(password)
 
     try:
-        c.execute(
-            "INSERT INTO admins (username, password_hash) VALUES (?, ?)",
-            (username, password_hash),
-        )
-        conn.commit()
+        with db_writer() as conn:
+            conn.execute(SQL_INSERT_ADMIN, (username, password_hash))
     except sqlite3.IntegrityError:
-        conn.close()
         return jsonify({"error": "Username already exists."}), 400
+    _invalidate_admin_caches()
 
-    conn.close()
     return jsonify({"status": "ok"})
 
 
@@ -295,16 +749,18 @@ def create_admin():
 def admin_menu_config():
     """Admin view/edit of menu config."""
     if request.method == "GET":
-        cfg = get_or_create_menu_config()
-        return jsonify(cfg)
+        body = _menu_config_entry()[1]
+        return Response(body, mimetype="application/json")
 
     # POST: save
     data = request.get_json() or {}
 
-    # Basic validation: ensure menu_json parses as JSON
-    try:
-        json.loads(data.get("menu_json", ""))
-    except json.JSONDecodeError:
+    # Basic validation: ensure menu_json is valid JSON (SQLite's C parser
+    # checks it without building Python objects we'd throw away)
+    menu_json = data.get("menu_json", "")
+    if not isinstance(menu_json, str) or not get_db().execute(
+        "SELECT json_valid(?)", (menu_json,)
+    ).fetchone()[0]:
         return jsonify({"error": "Menu JSON is not valid JSON."}), 400
 
     save_menu_config(data)
@@ -314,8 +770,15 @@ def admin_menu_config():
 @app.route("/api/menu_config", methods=["GET"])
 def public_menu_config():
     """Public endpoint for the website to fetch current menu config."""
-    cfg = get_or_create_menu_config()
-    return jsonify(cfg)
+    _, body, etag = _menu_config_entry()
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="application/json")
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 60
+    return resp
 
 
 
@@ -356,49 +819,45 @@ def api_order():
     if not phone:
         return jsonify({"error": "Phone is required"}), 400
 
-    # Upsert customer
-    conn = get_db()
-    c = conn.cursor()
+    try:
+        submit_write([
+            (SQL_UPSERT_CUSTOMER, (phone, name)),
+            (
+                SQL_INSERT_ORDER,
+                (
+                    phone,
+                    now_millis(),
+                    total,
+                    name, phone, pickup, notes, json.dumps(items), total,
+                ),
+            ),
+        ])
+    except FutureTimeoutError:
+        # Cancelled before it ran, so nothing was saved; safe to retry
+        return jsonify({"error": "Server busy, order not saved. Please try again."}), 503
 
-    c.execute("SELECT phone FROM customers WHERE phone = ?", (phone,))
-    row = c.fetchone()
-    if row is None:
-        c.execute(
-            "INSERT INTO customers (phone, name) VALUES (?, ?)",
-            (phone, name)
-        )
-    else:
-        # Optionally update name if changed
-        if name:
-            c.execute(
-                "UPDATE customers SET name = ? WHERE phone = ?",
-                (name, phone)
-            )
+    return jsonify({"status": "ok"})
 
-    # Prepare order JSON (store full payload for later review)
-    order_payload = {
-        "name": name,
-        "phone": phone,
-        "pickupOption": pickup,
-        "notes": notes,
-        "items": items,
-        "total": total,
-    }
 
-    c.execute(
-        "INSERT INTO orders (phone, created_at, total, data) VALUES (?, ?, ?, ?)",
-        (
-            phone,
-            datetime.utcnow().isoformat(),   # store in UTC
-            total,
-            json.dumps(order_payload),
-        ),
-    )
+# Rows fetched and written per chunk of the streamed CSV
+CSV_BATCH_ROWS = 256
 
-    conn.commit()
-    conn.close()
 
-    return jsonify({"status": "ok"})
+def month_bounds(month):
+    """
+    Turn "YYYY-MM" into [start, end) unix-millisecond bounds (UTC) for
+    created_at, so month filters are plain integer range compares.
+    Raises ValueError for anything that isn't a real month.
+    """
+    if len(month) != 7:
+        raise ValueError(month)
+    start = datetime.strptime(month + "-01", "%Y-%m-%d")
+    # Add the month's length rather than building next month's datetime,
+    # which doesn't exist after 9999-12
+    start_ms = calendar.timegm(start.timetuple()) * 1000
+    days = calendar.monthrange(start.year, start.month)[1]
+    return start_ms, start_ms + days * 86400000
+
 
 @app.route("/api/admin/summary_csv", methods=["GET"])
 @login_required
@@ -414,78 +873,83 @@ def admin_summary_csv():
       balance_lifetime
     """
     month = request.args.get("month", "").strip()  # "2024-11"
-    if not month or len(month) != 7 or month[4] != "-":
+    try:
+        month_start, month_end = month_bounds(month)
+    except ValueError:
         return jsonify({"error": "month param required in format YYYY-MM"}), 400
 
-    conn = get_db()
-    c = conn.cursor()
-
-    # We compute:
+    # We compute, with one grouped pass over each of orders / payments:
     # - total ordered in this month (orders)
     # - total paid in this month (payments)
     # - total ordered all time
     # - total paid all time
     # Then balance_lifetime = total_ordered_all - total_paid_all
-    c.execute("""
+    c = get_db().execute("""
+        WITH o AS (
+            SELECT
+                phone,
+                SUM(total) AS ordered_all,
+                SUM(CASE WHEN created_at >= :m0 AND created_at < :m1
+                         THEN total ELSE 0 END) AS ordered_month
+            FROM orders
+            GROUP BY phone
+        ),
+        p AS (
+            SELECT
+                phone,
+                SUM(amount) AS paid_all,
+                SUM(CASE WHEN created_at >= :m0 AND created_at < :m1
+                         THEN amount ELSE 0 END) AS paid_month
+            FROM payments
+            GROUP BY phone
+        )
         SELECT
             c.phone,
             COALESCE(c.name, '') AS name,
-            -- monthly ordered
-            COALESCE((
-                SELECT SUM(o.total)
-                FROM orders o
-                WHERE o.phone = c.phone
-                  AND substr(o.created_at, 1, 7) = ?
-            ), 0) AS total_ordered_month,
-            -- monthly paid
-            COALESCE((
-                SELECT SUM(p.amount)
-                FROM payments p
-                WHERE p.phone = c.phone
-                  AND substr(p.created_at, 1, 7) = ?
-            ), 0) AS total_paid_month,
-            -- lifetime ordered
-            COALESCE((
-                SELECT SUM(o2.total)
-                FROM orders o2
-                WHERE o2.phone = c.phone
-            ), 0) AS total_ordered_all,
-            -- lifetime paid
-            COALESCE((
-                SELECT SUM(p2.amount)
-                FROM payments p2
-                WHERE p2.phone = c.phone
-            ), 0) AS total_paid_all
+            COALESCE(o.ordered_month, 0) AS total_ordered_month,
+            COALESCE(p.paid_month, 0) AS total_paid_month,
+            COALESCE(o.ordered_all, 0) AS total_ordered_all,
+            COALESCE(p.paid_all, 0) AS total_paid_all
         FROM customers c
+        LEFT JOIN o ON o.phone = c.phone
+        LEFT JOIN p ON p.phone = c.phone
         ORDER BY c.phone
-    """, (month, month))
-    rows = c.fetchall()
-    conn.close()
+    """, {"m0": month_start, "m1": month_end})
 
-    header = f"phone,name,total_ordered_{month},total_paid_{month},balance_lifetime"
-    lines = [header]
+    header = ["phone", "name", f"total_ordered_{month}", f"total_paid_{month}",
+              "balance_lifetime"]
 
-    for r in rows:
-        total_ordered_month = round(r["total_ordered_month"], 2)
-        total_paid_month = round(r["total_paid_month"], 2)
-        total_ordered_all = round(r["total_ordered_all"], 2)
-        total_paid_all = round(r["total_paid_all"], 2)
-        balance_lifetime = total_ordered_all - total_paid_all
-
-        phone = r["phone"]
-        name = (r["name"] or "").replace('"', '""')  # basic escaping
-
-        lines.append(
-            f'{phone},"{name}",'
-            f'{total_ordered_month:.2f},'
-            f'{total_paid_month:.2f},'
-            f'{balance_lifetime:.2f}'
-        )
+    def generate():
+        # csv.writer handles quoting/escaping; flush the buffer every batch
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        try:
+            writer.writerow(header)
+            while True:
+                rows = c.fetchmany(CSV_BATCH_ROWS)
+                if not rows:
+                    break
+                for r in rows:
+                    total_ordered_all = round(r["total_ordered_all"], 2)
+                    total_paid_all = round(r["total_paid_all"], 2)
+                    writer.writerow((
+                        r["phone"],
+                        r["name"],
+                        f'{r["total_ordered_month"]:.2f}',
+                        f'{r["total_paid_month"]:.2f}',
+                        f"{total_ordered_all - total_paid_all:.2f}",
+                    ))
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            if buf.tell():
+                yield buf.getvalue()
+        finally:
+            c.close()
 
-    csv_data = "\n".join(lines) + "\n"
     filename = f"annapurna_monthly_summary_{month}.csv"
     return Response(
-        csv_data,
+        stream_with_context(generate()),
         mimetype="text/csv",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'}
     )
@@ -498,10 +962,7 @@ def admin_summary():
     Returns customer-level summary:
     phone, name, total_ordered, total_paid, balance
     """
-    conn = get_db()
-    c = conn.cursor()
-
-    c.execute("""
+    rows = get_db().execute("""
         SELECT
             c.phone,
             COALESCE(c.name, '') AS name,
@@ -515,10 +976,7 @@ def admin_summary():
         LEFT JOIN orders o ON o.phone = c.phone
         GROUP BY c.phone, c.name
         ORDER BY c.phone
-    """)
-
-    rows = c.fetchall()
-    conn.close()
+    """).fetchall()
 
     result = []
     for r in rows:
@@ -536,6 +994,45 @@ def admin_summary():
     return jsonify(result)
 
 
+# Per-row JSON for the admin order/payment lists; unreadable order data -> {}
+ORDER_JSON_EXPR = """json_object(
+    'id', id,
+    'created_at', created_at_iso,
+    'total', total,
+    'data', json(CASE WHEN json_valid(data) THEN data ELSE '{}' END)
+)"""
+PAYMENT_JSON_EXPR = """json_object(
+    'id', id,
+    'created_at', created_at_iso,
+    'amount', amount,
+    'note', COALESCE(note, '')
+)"""
+
+# json_group_array only has a defined input order with an aggregate ORDER BY
+# (SQLite 3.44+). On older SQLite, fetch the ordered per-row objects instead
+# and join them into the array here.
+_AGGREGATE_ORDER_BY = sqlite3.sqlite_version_info >= (3, 44, 0)
+if _AGGREGATE_ORDER_BY:
+    _JSON_LIST_SQL = (
+        "SELECT json_group_array({expr} ORDER BY created_at DESC, id DESC) "
+        "FROM {table} WHERE phone = ?"
+    )
+else:
+    _JSON_LIST_SQL = (
+        "SELECT {expr} FROM {table} WHERE phone = ? ORDER BY created_at DESC, id DESC"
+    )
+SQL_ORDERS_JSON = _JSON_LIST_SQL.format(expr=ORDER_JSON_EXPR, table="orders")
+SQL_PAYMENTS_JSON = _JSON_LIST_SQL.format(expr=PAYMENT_JSON_EXPR, table="payments")
+
+
+def json_array_newest_first(sql, phone):
+    """Run SQL_ORDERS_JSON / SQL_PAYMENTS_JSON and return the JSON array text."""
+    rows = get_db().execute(sql, (phone,)).fetchall()
+    if _AGGREGATE_ORDER_BY:
+        return rows[0][0]
+    return "[" + ",".join(r[0] for r in rows) + "]"
+
+
 @app.route("/api/admin/orders", methods=["GET"])
 @login_required
 def admin_orders():
@@ -546,31 +1043,8 @@ def admin_orders():
     if not phone:
         return jsonify({"error": "phone is required"}), 400
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        SELECT id, created_at, total, data
-        FROM orders
-        WHERE phone = ?
-        ORDER BY created_at DESC
-    """, (phone,))
-    rows = c.fetchall()
-    conn.close()
-
-    orders = []
-    for r in rows:
-        try:
-            payload = json.loads(r["data"])
-        except Exception:
-            payload = {}
-        orders.append({
-            "id": r["id"],
-            "created_at": r["created_at"],
-            "total": r["total"],
-            "data": payload,
-        })
-
-    return jsonify(orders)
+    body = json_array_newest_first(SQL_ORDERS_JSON, phone)
+    return Response(body, mimetype="application/json")
 
 
 @app.route("/api/admin/payments", methods=["GET", "POST"])
@@ -585,27 +1059,8 @@ def admin_payments():
         if not phone:
             return jsonify({"error": "phone is required"}), 400
 
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT id, created_at, amount, note
-            FROM payments
-            WHERE phone = ?
-            ORDER BY created_at DESC
-        """, (phone,))
-        rows = c.fetchall()
-        conn.close()
-
-        payments = [
-            {
-                "id": r["id"],
-                "created_at": r["created_at"],
-                "amount": r["amount"],
-                "note": r["note"] or "",
-            }
-            for r in rows
-        ]
-        return jsonify(payments)
+        body = json_array_newest_first(SQL_PAYMENTS_JSON, phone)
+        return Response(body, mimetype="application/json")
 
     # POST
     data = request.get_json(force=True)
@@ -618,19 +1073,13 @@ def admin_payments():
     if amount <= 0:
         return jsonify({"error": "amount must be > 0"}), 400
 
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO payments (phone, created_at, amount, note)
-        VALUES (?, ?, ?, ?)
-    """, (
-        phone,
-        datetime.utcnow().isoformat(),
-        amount,
-        note
-    ))
-    conn.commit()
-    conn.close()
+    try:
+        submit_write([
+            (SQL_INSERT_PAYMENT, (phone, now_millis(), amount, note)),
+        ])
+    except FutureTimeoutError:
+        # Cancelled before it ran, so nothing was saved; safe to retry
+        return jsonify({"error": "Server busy, payment not saved. Please try again."}), 503
 
     return jsonify({"status": "ok"})
 